@@ -1,11 +1,20 @@
+import concurrent.futures
+import functools
+import hashlib
+import io
 import firebase_admin
 from firebase_admin import credentials, firestore, storage
 import functions_framework
+import google.auth
+import logging
+from google.auth.transport import requests as google_auth_requests
 from google.cloud import texttospeech, exceptions as google_cloud_exceptions
 import os
 import replicate
-import requests 
-from datetime import datetime
+import requests
+import time
+from datetime import timedelta
+from urllib3.util.retry import Retry
 
 # --- 전역 초기화 ---
 try:
@@ -13,16 +22,59 @@ try:
 except ValueError:
     firebase_admin.initialize_app()
 
+# print 대신 stdlib 로거를 사용합니다. %s 포맷은 레벨에서 걸러지면 평가되지 않고,
+# google-cloud-logging이 레코드를 배치로 전송하므로 요청당 stdout 쓰기가 줄어듭니다.
+# basicConfig로 루트 핸들러를 INFO 레벨로 구성해야 INFO 레코드가 실제로 출력됩니다
+# (핸들러가 없으면 lastResort 핸들러가 WARNING 미만을 모두 버립니다).
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 환경 구성은 모듈 로드 시 한 번만 읽습니다. 토큰이 없으면 컨테이너 기동 자체가
+# 실패하므로 잘못된 구성으로 요청을 받는 일이 없습니다 (fail-fast).
+REPLICATE_API_TOKEN = os.environ["REPLICATE_API_TOKEN"]
+WEBHOOK_BASE_URL = os.environ.get("WEBHOOK_BASE_URL")
+
 # Lazy loading을 위해 클라이언트 초기화를 None으로 변경
 bucket = None  # 기본 Firebase Storage 버킷
 db = None    # Firestore 클라이언트, 전역 또는 함수별로 초기화 가능
+tts_client = None  # Google TTS 클라이언트, 컨테이너당 한 번만 초기화
+replicate_client = None  # Replicate 클라이언트, 컨테이너당 한 번만 초기화
+signing_credentials = None  # 서명 URL 생성용 자격 증명, 컨테이너당 한 번만 로드
+
+# 워밍된 함수 인스턴스에서 TLS 연결을 재사용하기 위한 모듈 전역 HTTP 세션
+SESSION = requests.Session()
+SESSION.mount("https://", requests.adapters.HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+))
+
+# 응답을 막지 않아야 하는 백그라운드 작업(Firestore 메타데이터 저장 등)용 실행기
+_BG_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+# 기본 TTS 음성 설정. 음성이 요청별로 구성 가능해지더라도 protobuf 객체는
+# 파라미터 조합별로 한 번만 생성되도록 _voice_params로 메모이즈합니다.
+DEFAULT_VOICE_LANGUAGE = "en-US"
+DEFAULT_VOICE_NAME = "en-US-Standard-C"
+
+@functools.lru_cache(maxsize=32)
+def _voice_params(language_code, name, ssml_gender):
+    """주어진 조합에 대한 VoiceSelectionParams를 생성하고 메모이즈합니다."""
+    return texttospeech.VoiceSelectionParams(
+        language_code=language_code, name=name, ssml_gender=ssml_gender
+    )
+
+# 오디오 인코딩 설정은 상수이므로 모듈 로드 시 한 번만 생성합니다.
+_TTS_AUDIO_CONFIG = texttospeech.AudioConfig(
+    audio_encoding=texttospeech.AudioEncoding.MP3
+)
 
 # --- Getter 함수 정의 ---
 def get_storage_bucket():
     """Firebase Storage 버킷 클라이언트를 반환합니다 (필요시 초기화)."""
     global bucket
     if bucket is None:
-        print("Firebase Storage 버킷 클라이언트 초기화 중...")
+        logger.info("Firebase Storage 버킷 클라이언트 초기화 중...")
         bucket = storage.bucket()
     return bucket
 
@@ -30,10 +82,36 @@ def get_firestore_client():
     """Firestore 클라이언트를 반환합니다 (필요시 초기화)."""
     global db
     if db is None:
-        print("Firestore 클라이언트 초기화 중...")
+        logger.info("Firestore 클라이언트 초기화 중...")
         db = firestore.client()
     return db
 
+def get_tts_client():
+    """Google TTS 클라이언트를 반환합니다 (필요시 초기화)."""
+    global tts_client
+    if tts_client is None:
+        logger.info("Text-to-Speech 클라이언트 초기화 중...")
+        tts_client = texttospeech.TextToSpeechClient()
+    return tts_client
+
+def get_replicate_client():
+    """Replicate 클라이언트를 반환합니다 (필요시 초기화)."""
+    global replicate_client
+    if replicate_client is None:
+        logger.info("Replicate 클라이언트 초기화 중...")
+        replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN)
+    return replicate_client
+
+def get_signing_credentials():
+    """서명 URL 생성에 사용할 자격 증명을 반환합니다 (필요시 초기화/갱신)."""
+    global signing_credentials
+    if signing_credentials is None:
+        logger.info("서명용 자격 증명 초기화 중...")
+        signing_credentials, _ = google.auth.default()
+    if not signing_credentials.valid:
+        signing_credentials.refresh(google_auth_requests.Request())
+    return signing_credentials
+
 # --- 헬퍼 함수 정의 ---
 
 class OperationFailure(Exception):
@@ -42,95 +120,130 @@ class OperationFailure(Exception):
         super().__init__(message)
         self.status_code = status_code
 
-def download_avatar_image(bucket_client, avatar_storage_path, temp_avatar_path):
-    """Firebase Storage에서 아바타 이미지를 다운로드합니다."""
+# 생성된 비디오 서명 URL의 유효 기간
+SIGNED_URL_EXPIRATION = timedelta(days=7)
+
+def build_video_access_url(blob):
+    """비디오 blob에 대한 V4 서명 URL을 생성합니다.
+
+    Cloud Functions의 기본 컴퓨트 자격 증명에는 개인 키가 없어 로컬 서명이
+    불가능하므로, service_account_email과 access_token을 전달하여 IAM signBlob
+    API에 서명을 위임합니다.
+    """
+    signing = get_signing_credentials()
+    return blob.generate_signed_url(
+        version="v4",
+        expiration=SIGNED_URL_EXPIRATION,
+        method="GET",
+        service_account_email=signing.service_account_email,
+        access_token=signing.token,
+    )
+
+def build_tts_cache_key(script_text):
+    """TTS 입력(스크립트 + 음성 설정)에 대한 캐시 키를 계산합니다."""
+    return hashlib.sha256(f"{script_text}|{DEFAULT_VOICE_NAME}|MP3".encode()).hexdigest()
+
+def build_video_cache_key(avatar_id, tts_cache_key):
+    """아바타와 TTS 입력 조합에 대한 립싱크 비디오 캐시 키를 계산합니다."""
+    return hashlib.sha256(f"{avatar_id}|{tts_cache_key}".encode()).hexdigest()
+
+def download_avatar_image(bucket_client, avatar_storage_path):
+    """Firebase Storage에서 아바타 이미지를 메모리로 다운로드하여 바이트로 반환합니다."""
     try:
-        blob = bucket_client.blob(avatar_storage_path)
-        blob.download_to_filename(temp_avatar_path)
-        print(f"아바타 이미지 '{avatar_storage_path}'를 '{temp_avatar_path}'로 다운로드했습니다.")
-        return True
+        avatar_bytes = bucket_client.blob(avatar_storage_path).download_as_bytes()
+        logger.info("아바타 이미지 '%s'를 다운로드했습니다 (%s바이트).", avatar_storage_path, len(avatar_bytes))
+        return avatar_bytes
     except google_cloud_exceptions.NotFound:
-        print(f"오류: '{avatar_storage_path}'에서 아바타 이미지를 찾을 수 없습니다.")
+        logger.error("'%s'에서 아바타 이미지를 찾을 수 없습니다.", avatar_storage_path)
         raise OperationFailure(f"'{avatar_storage_path}'에서 아바타 이미지를 찾을 수 없습니다.", 404)
     except Exception as e:
-        print(f"오류: 아바타 '{avatar_storage_path}' 다운로드에 실패했습니다. 세부 정보: {e}")
+        logger.error("아바타 '%s' 다운로드에 실패했습니다. 세부 정보: %s", avatar_storage_path, e)
         raise OperationFailure(f"아바타 이미지 다운로드에 실패했습니다. 서버 오류: {e}", 500)
 
-def generate_tts_audio(script_text, tts_client, temp_audio_path):
-    """TTS 오디오를 생성하고 임시 경로에 저장합니다."""
+def generate_tts_audio(script_text, tts_client, bucket_client, cache_key):
+    """TTS 오디오를 생성하여 바이트로 반환합니다. 동일한 입력은 GCS 캐시에서 재사용합니다."""
+    cache_blob = bucket_client.blob(f"tts-cache/{cache_key}.mp3")
+    try:
+        audio_content = cache_blob.download_as_bytes()
+        logger.info("TTS 캐시 적중: %s", cache_blob.name)
+        return audio_content
+    except google_cloud_exceptions.NotFound:
+        pass  # 캐시 미스, 새로 합성합니다.
+    except Exception as e:
+        logger.warning("TTS 캐시 조회 실패, 새로 합성합니다: %s", e)
     try:
         synthesis_input = texttospeech.SynthesisInput(text=script_text)
-        voice = texttospeech.VoiceSelectionParams(
-            language_code="en-US",
-            name="en-US-Standard-C",
-            ssml_gender=texttospeech.SsmlVoiceGender.FEMALE
-        )
-        audio_config = texttospeech.AudioConfig(
-            audio_encoding=texttospeech.AudioEncoding.MP3
+        voice = _voice_params(
+            DEFAULT_VOICE_LANGUAGE, DEFAULT_VOICE_NAME, texttospeech.SsmlVoiceGender.FEMALE
         )
         response = tts_client.synthesize_speech(
-            input=synthesis_input, voice=voice, audio_config=audio_config
+            input=synthesis_input, voice=voice, audio_config=_TTS_AUDIO_CONFIG
         )
-        with open(temp_audio_path, "wb") as out:
-            out.write(response.audio_content)
-        print(f'오디오 콘텐츠를 파일 "{temp_audio_path}"에 작성했습니다.')
-        return True
+        audio_content = response.audio_content
+        logger.info("TTS 오디오를 생성했습니다 (%s바이트).", len(audio_content))
     except Exception as e:
-        print(f"TTS 생성 중 오류 발생: {e}")
+        logger.error("TTS 생성 중 오류 발생: %s", e)
         raise OperationFailure(f"TTS 생성 실패: {e}", 500)
+    try:
+        # 캐시 저장은 best-effort입니다. 실패해도 요청 처리는 계속합니다.
+        # if_generation_match=0: 다른 인스턴스가 먼저 저장했다면 중복 업로드를 건너뜁니다.
+        cache_blob.upload_from_string(audio_content, content_type="audio/mpeg", if_generation_match=0)
+        logger.info("TTS 캐시 저장: %s", cache_blob.name)
+    except Exception as e:
+        logger.warning("TTS 캐시 저장 실패: %s", e)
+    return audio_content
 
-def perform_lip_sync(replicate_client, temp_avatar_path, temp_audio_path):
-    """Replicate API를 호출하여 립싱크를 수행하고 비디오 URL을 반환합니다."""
-    print(f"아바타 '{temp_avatar_path}'와 오디오 '{temp_audio_path}'로 립싱크 프로세스를 시작합니다.")
+# SadTalker 모델의 Replicate 버전 해시
+SADTALKER_VERSION = "3aa2daf61579702c6ba2411452269943457be29cc01be511252541925a0c090d"
+
+def start_lip_sync(replicate_client, avatar_bytes, audio_bytes, webhook_url):
+    """Replicate 립싱크 예측을 비동기로 시작하고 prediction 객체를 반환합니다.
+
+    결과를 기다리지 않습니다. 완료 시 Replicate가 webhook_url로 결과를 전송합니다.
+    """
+    logger.info("아바타 %s바이트와 오디오 %s바이트로 립싱크 예측을 시작합니다.", len(avatar_bytes), len(audio_bytes))
     try:
-        output = replicate_client.run(
-            "cjwb/sadtalker:3aa2daf61579702c6ba2411452269943457be29cc01be511252541925a0c090d",
+        prediction = replicate_client.predictions.create(
+            version=SADTALKER_VERSION,
             input={
-                "source_image": open(temp_avatar_path, "rb"),
-                "driven_audio": open(temp_audio_path, "rb"),
+                "source_image": io.BytesIO(avatar_bytes),
+                "driven_audio": io.BytesIO(audio_bytes),
                 "preprocess": "full",
                 "still_mode": True,
                 "enhancer": "gfpgan"
-            }
+            },
+            webhook=webhook_url,
+            webhook_events_filter=["completed"]
         )
-        replicate_video_url = output
-        if not replicate_video_url: # API 호출이 성공하면 발생하지 않아야 합니다.
-             raise OperationFailure("립싱크 프로세스에서 Replicate로부터 비디오 URL을 반환하지 않았습니다.", 500)
-        print(f"Replicate에서 생성된 비디오 URL: {replicate_video_url}")
-        return replicate_video_url
+        logger.info("Replicate 예측이 시작되었습니다: %s", prediction.id)
+        return prediction
     except replicate.exceptions.ReplicateError as e:
-        print(f"Replicate API 오류: {e}")
-        raise OperationFailure(f"Replicate API 오류로 인해 립싱크 생성에 실패했습니다: {e}", 500)
+        logger.error("Replicate API 오류: %s", e)
+        raise OperationFailure(f"Replicate API 오류로 인해 립싱크 시작에 실패했습니다: {e}", 500)
     except Exception as e: # 파일 I/O와 같은 다른 잠재적 오류를 포착합니다.
-        print(f"립싱크 Replicate 호출 중 오류 발생: {e}")
-        raise OperationFailure(f"립싱크 프로세스 실패: {e}", 500)
+        logger.error("립싱크 Replicate 호출 중 오류 발생: %s", e)
+        raise OperationFailure(f"립싱크 프로세스 시작 실패: {e}", 500)
 
-def download_replicate_video(video_url, temp_video_path):
-    """Replicate URL에서 비디오를 임시 경로로 다운로드합니다."""
+def stream_replicate_to_gcs(video_url, bucket_client, storage_path):
+    """Replicate URL의 비디오를 임시 파일 없이 Firebase Storage로 직접 스트리밍하고 공개 URL을 반환합니다."""
     try:
-        video_response = requests.get(video_url, stream=True)
+        video_response = SESSION.get(video_url, stream=True)
         video_response.raise_for_status()  # 잘못된 응답(4XX 또는 5XX)에 대해 HTTPError를 발생시킵니다.
-        with open(temp_video_path, "wb") as f:
-            for chunk in video_response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        print(f"Replicate에서 생성된 비디오를 {temp_video_path}(으)로 다운로드했습니다.")
-        return True
+        video_response.raw.decode_content = True
     except requests.exceptions.RequestException as e:
-        print(f"Replicate URL '{video_url}'에서 비디오 다운로드에 실패했습니다: {e}")
+        logger.error("Replicate URL '%s'에서 비디오 다운로드에 실패했습니다: %s", video_url, e)
         raise OperationFailure(f"Replicate에서 생성된 비디오 다운로드에 실패했습니다: {e}", 500)
-
-def upload_to_firebase_storage(bucket_client, temp_video_path, storage_path):
-    """비디오를 Firebase Storage에 업로드하고 공개 URL을 반환합니다."""
     try:
         blob = bucket_client.blob(storage_path)
-        blob.upload_from_filename(temp_video_path)
-        blob.make_public()
-        video_storage_url = blob.public_url
-        print(f"비디오를 Firebase Storage에 업로드했습니다: {storage_path}")
-        print(f"공개 URL: {video_storage_url}")
+        # Content-Length를 알면 단일 업로드 경로를 사용할 수 있습니다.
+        content_length = int(video_response.headers.get("Content-Length", 0)) or None
+        blob.upload_from_file(video_response.raw, content_type="video/mp4", size=content_length)
+        video_storage_url = build_video_access_url(blob)
+        logger.info("Replicate 비디오를 Firebase Storage로 직접 스트리밍했습니다: %s", storage_path)
+        logger.info("서명 URL: %s", video_storage_url)
         return video_storage_url
     except Exception as e:
-        print(f"Firebase Storage의 '{storage_path}'에 비디오 업로드 실패: {e}")
+        logger.error("Firebase Storage의 '%s'에 비디오 업로드 실패: %s", storage_path, e)
         raise OperationFailure(f"Firebase Storage에 비디오 업로드 실패: {e}", 500)
 
 def save_metadata_to_firestore(db_client, user_id, video_url, script_text, avatar_id):
@@ -144,21 +257,48 @@ def save_metadata_to_firestore(db_client, user_id, video_url, script_text, avata
             "createdAt": firestore.SERVER_TIMESTAMP,
             "status": "completed"
         })
-        print(f"메타데이터를 Firestore에 문서 ID {doc_ref_tuple[1].id}(으)로 저장했습니다.")
+        logger.info("메타데이터를 Firestore에 문서 ID %s(으)로 저장했습니다.", doc_ref_tuple[1].id)
     except Exception as e:
         # MVP의 경우 경고를 기록하지만 전체 작업을 실패시키지는 않습니다.
-        print(f"경고: Firestore에 메타데이터 저장 실패: {e}")
+        logger.warning("Firestore에 메타데이터 저장 실패: %s", e)
+
+def create_pending_video_doc(db_client, prediction_id, user_id, script_text, avatar_id,
+                             storage_path, cache_path):
+    """진행 중인 비디오 생성 작업을 Firestore에 기록합니다.
+
+    문서 ID로 Replicate prediction ID를 사용하여 웹훅 처리기가 작업 컨텍스트
+    (저장 경로, 캐시 경로)를 바로 조회할 수 있게 합니다.
+    """
+    try:
+        db_client.collection("video_creations").document(prediction_id).set({
+            "userId": user_id,
+            "scriptText": script_text,
+            "avatarId": avatar_id,
+            "storagePath": storage_path,
+            "videoCachePath": cache_path,
+            "createdAt": firestore.SERVER_TIMESTAMP,
+            "status": "processing"
+        })
+        logger.info("진행 중 메타데이터를 Firestore에 문서 ID %s(으)로 저장했습니다.", prediction_id)
+    except Exception as e:
+        # 이 문서가 없으면 웹훅이 작업을 완료할 수 없으므로 여기서는 실패해야 합니다.
+        logger.error("Firestore에 진행 중 메타데이터 저장 실패: %s", e)
+        raise OperationFailure(f"작업 메타데이터 저장에 실패했습니다: {e}", 500)
 
 # --- 메인 클라우드 함수 ---
 @functions_framework.http
-def generateAvatarVideo(request):
-    """아바타 비디오 생성 프로세스를 조정합니다."""
-    
+def startAvatarVideo(request):
+    """아바타 비디오 생성을 시작합니다 (1단계: 입력 준비 + Replicate 예측 시작).
+
+    Replicate 예측이 끝나기를 기다리지 않고 prediction ID와 함께 202를 반환합니다.
+    업로드와 메타데이터 완료 처리는 웹훅으로 호출되는 finishAvatarVideo가 수행합니다.
+    캐시 적중 시에는 예측 없이 바로 완료(200)를 반환합니다.
+    """
+
     # --- 초기 설정 및 매개변수 유효성 검사 ---
-    REPLICATE_API_TOKEN = os.environ.get("REPLICATE_API_TOKEN")
-    if not REPLICATE_API_TOKEN:
-        print("오류: REPLICATE_API_TOKEN 환경 변수가 설정되지 않았습니다.")
-        return "구성 오류: Replicate API 토큰을 찾을 수 없습니다.", 500
+    if not WEBHOOK_BASE_URL:
+        logger.error("WEBHOOK_BASE_URL 환경 변수가 설정되지 않았습니다.")
+        return "구성 오류: 웹훅 기본 URL을 찾을 수 없습니다.", 500
 
     request_json = request.get_json(silent=True)
     if not request_json:
@@ -173,69 +313,152 @@ def generateAvatarVideo(request):
     if not avatar_id:
         return "잘못된 요청: 'avatar_id'가 비어 있거나 누락되었습니다.", 400
 
-    # --- API 클라이언트 초기화 ---
-    try:
-        tts_client = texttospeech.TextToSpeechClient()
-        replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN)
-    except Exception as e:
-        print(f"API 클라이언트 초기화 중 오류 발생: {e}")
-        return "필수 API 클라이언트를 초기화하지 못했습니다.", 500
-
-    # --- 임시 파일 경로 정의 ---
-    # 고유한 이름은 여러 함수 인스턴스가 실행될 경우 충돌을 방지하는 데 도움이 됩니다.
-    execution_id = request.headers.get('Function-Execution-Id', datetime.now().strftime('%Y%m%d%H%M%S%f'))
-    temp_avatar_path = f"/tmp/avatar_{execution_id}.png"
-    temp_audio_path = f"/tmp/output_{execution_id}.mp3"
-    temp_video_path = f"/tmp/final_video_{execution_id}.mp4"
-    
     final_video_storage_url = None
 
     try:
-        # --- Step 1: Download Avatar Image ---
         current_bucket_client = get_storage_bucket()
         avatar_storage_path = f"avatars/default/{avatar_id}" # .png로 가정, 필요한 경우 조정
-        download_avatar_image(current_bucket_client, avatar_storage_path, temp_avatar_path)
-
-        # --- Step 2: Generate TTS Audio ---
-        generate_tts_audio(script_text, tts_client, temp_audio_path)
-
-        # --- Step 3: Perform Lip Sync (via Replicate) ---
-        replicate_video_url = perform_lip_sync(replicate_client, temp_avatar_path, temp_audio_path)
-        
-        # --- Step 4: Download Video from Replicate ---
-        download_replicate_video(replicate_video_url, temp_video_path)
 
-        # --- Step 5: Upload Final Video to Firebase Storage ---
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        # --- 최종 저장 경로 및 캐시 키 계산 ---
+        timestamp = time.strftime("%Y%m%d_%H%M%S", time.gmtime())  # UTC
         base_avatar_id = avatar_id.split('.')[0] # 확장자가 있는 경우 제거
         storage_video_filename = f"{timestamp}_{base_avatar_id}.mp4"
         final_storage_path = f"generated_videos/{user_id}/{storage_video_filename}"
-        
-        # current_bucket_client는 이미 위에서 get_storage_bucket()으로 가져왔으므로 재사용
-        final_video_storage_url = upload_to_firebase_storage(current_bucket_client, temp_video_path, final_storage_path)
-        if not final_video_storage_url: # 예외로 처리되어야 하지만 안전 장치로 사용합니다.
-            raise OperationFailure("업로드 후 비디오 URL을 가져오는 데 실패했지만 예외는 발생하지 않았습니다.", 500)
+        tts_cache_key = build_tts_cache_key(script_text)
+        video_cache_path = f"lipsync-cache/{build_video_cache_key(avatar_id, tts_cache_key)}.mp4"
 
-        # --- Step 6: Save Metadata to Firestore ---
-        current_db_client = get_firestore_client()
-        save_metadata_to_firestore(current_db_client, user_id, final_video_storage_url, script_text, avatar_id)
+        # --- Step 0: Check Lip Sync Video Cache ---
+        # Replicate 호출(~30-60초)이 가장 큰 비용이므로 동일한 입력 조합은
+        # 캐시된 비디오를 최종 경로로 서버 측 복사하여 바로 제공합니다.
+        cached_video_blob = current_bucket_client.blob(video_cache_path)
+        if cached_video_blob.exists():
+            logger.info("립싱크 캐시 적중: %s", video_cache_path)
+            final_blob = current_bucket_client.copy_blob(cached_video_blob, current_bucket_client, final_storage_path)
+            final_video_storage_url = build_video_access_url(final_blob)
+            _BG_EXECUTOR.submit(
+                save_metadata_to_firestore, get_firestore_client(),
+                user_id, final_video_storage_url, script_text, avatar_id
+            )
+            logger.info("비디오를 성공적으로 생성했습니다 (캐시): %s", final_video_storage_url)
+            return {"message": "비디오가 성공적으로 생성되었습니다!", "video_url": final_video_storage_url}, 200
+
+        # --- 사전 확인: 아바타 존재 여부 ---
+        # 아바타가 없는 요청이 TTS 합성(문자당 과금)까지 실행하지 않도록
+        # 병렬 실행 전에 메타데이터 RPC 한 번으로 빠르게 실패합니다.
+        if not current_bucket_client.blob(avatar_storage_path).exists():
+            logger.error("'%s'에서 아바타 이미지를 찾을 수 없습니다.", avatar_storage_path)
+            raise OperationFailure(f"'{avatar_storage_path}'에서 아바타 이미지를 찾을 수 없습니다.", 404)
+
+        # --- Step 1 & 2: Download Avatar Image + Generate TTS Audio (병렬 실행) ---
+        # 두 단계는 서로 독립적인 네트워크 I/O이므로 동시에 실행하여
+        # 대기 시간을 두 단계의 합이 아닌 최대값으로 줄입니다.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            avatar_future = executor.submit(
+                download_avatar_image, current_bucket_client, avatar_storage_path
+            )
+            tts_future = executor.submit(
+                generate_tts_audio, script_text, get_tts_client(),
+                current_bucket_client, tts_cache_key
+            )
+            # result() 호출 시 작업 중 발생한 OperationFailure가 그대로 전파됩니다.
+            avatar_bytes = avatar_future.result()
+            audio_bytes = tts_future.result()
+
+        # --- Step 3: Start Lip Sync Prediction (via Replicate, 비동기) ---
+        # 30-60초짜리 예측을 기다리며 과금 시간을 낭비하지 않도록 웹훅으로 완료를 받습니다.
+        webhook_url = f"{WEBHOOK_BASE_URL.rstrip('/')}/finishAvatarVideo"
+        prediction = start_lip_sync(get_replicate_client(), avatar_bytes, audio_bytes, webhook_url)
+
+        # --- Step 4: Save Pending Metadata to Firestore ---
+        # 웹훅 처리기가 이 문서에서 저장/캐시 경로를 조회하므로 동기적으로 기록합니다.
+        create_pending_video_doc(
+            get_firestore_client(), prediction.id, user_id, script_text, avatar_id,
+            final_storage_path, video_cache_path
+        )
+
+        logger.info("비디오 생성을 시작했습니다. prediction ID: %s", prediction.id)
+        return {"message": "비디오 생성이 시작되었습니다.", "prediction_id": prediction.id}, 202
+
+    except OperationFailure as e:
+        logger.error("작업 실패: %s", e)
+        return str(e), e.status_code
+    except Exception as e:
+        # 프로세스 중 예기치 않은 오류를 모두 포착합니다.
+        logger.exception("예기치 않은 오류 발생: %s", e)
+        return "예기치 않은 서버 오류가 발생했습니다.", 500
+
+@functions_framework.http
+def finishAvatarVideo(request):
+    """Replicate 웹훅을 받아 비디오 생성을 마무리합니다 (2단계: 업로드 + 메타데이터 완료)."""
+    payload = request.get_json(silent=True)
+    if not payload or not payload.get("id"):
+        return "잘못된 요청: 유효한 웹훅 페이로드가 없습니다.", 400
+
+    prediction_id = payload["id"]
+    doc_ref = get_firestore_client().collection("video_creations").document(prediction_id)
+
+    try:
+        doc = doc_ref.get()
+        if not doc.exists:
+            logger.error("prediction '%s'에 대한 작업 문서를 찾을 수 없습니다.", prediction_id)
+            return "알 수 없는 prediction ID입니다.", 404
+
+        # 웹훅 페이로드는 서명 검증 없이는 위조될 수 있으므로 알림으로만 취급하고,
+        # 상태와 출력 URL은 Replicate API에서 직접 조회한 값만 신뢰합니다.
+        # (위조된 페이로드로 임의 URL이 사용자 저장소와 공용 캐시에 업로드되는 것을 막습니다.)
+        try:
+            prediction = get_replicate_client().predictions.get(prediction_id)
+        except replicate.exceptions.ReplicateError as e:
+            logger.error("prediction '%s' 조회 실패: %s", prediction_id, e)
+            raise OperationFailure(f"Replicate에서 prediction 상태를 확인하지 못했습니다: {e}", 502)
+
+        if prediction.status != "succeeded":
+            if prediction.status in ("failed", "canceled"):
+                logger.warning("prediction '%s' 실패: %s", prediction_id, prediction.error)
+                doc_ref.update({"status": "failed", "error": str(prediction.error)})
+                return {"message": "실패가 기록되었습니다."}, 200  # 웹훅 재시도를 막기 위해 200으로 응답
+            # 아직 완료되지 않았다면(위조되었거나 너무 이른 웹훅) 아무것도 기록하지 않습니다.
+            logger.warning("prediction '%s'가 아직 완료되지 않았습니다 (상태: %s).", prediction_id, prediction.status)
+            return "prediction이 아직 완료되지 않았습니다.", 409
+
+        output = prediction.output
+        replicate_video_url = output if isinstance(output, str) else (output[0] if output else None)
+        if not replicate_video_url:
+            doc_ref.update({"status": "failed", "error": "예측 결과에 출력 URL이 없습니다."})
+            raise OperationFailure("Replicate 예측 결과에서 비디오 URL을 찾을 수 없습니다.", 500)
+
+        task = doc.to_dict()
+        current_bucket_client = get_storage_bucket()
+
+        # --- Step 5: Stream Video from Replicate to Firebase Storage ---
+        # /tmp를 거치지 않고 Replicate 응답 스트림을 그대로 업로드합니다.
+        final_storage_path = task["storagePath"]
+        final_video_storage_url = stream_replicate_to_gcs(replicate_video_url, current_bucket_client, final_storage_path)
+
+        # --- Step 6: Populate Lip Sync Video Cache (best-effort) ---
+        try:
+            current_bucket_client.copy_blob(
+                current_bucket_client.blob(final_storage_path), current_bucket_client,
+                task["videoCachePath"], if_generation_match=0
+            )
+            logger.info("립싱크 캐시 저장: %s", task['videoCachePath'])
+        except Exception as e:
+            logger.warning("립싱크 캐시 저장 실패: %s", e)
+
+        # --- Step 7: Mark Metadata Completed ---
+        doc_ref.update({
+            "videoUrl": final_video_storage_url,
+            "status": "completed",
+            "completedAt": firestore.SERVER_TIMESTAMP
+        })
 
-        print(f"비디오를 성공적으로 생성했습니다: {final_video_storage_url}")
+        logger.info("비디오를 성공적으로 생성했습니다: %s", final_video_storage_url)
         return {"message": "비디오가 성공적으로 생성되었습니다!", "video_url": final_video_storage_url}, 200
 
     except OperationFailure as e:
-        print(f"작업 실패: {e}")
+        logger.error("작업 실패: %s", e)
         return str(e), e.status_code
     except Exception as e:
         # 프로세스 중 예기치 않은 오류를 모두 포착합니다.
-        print(f"예기치 않은 오류 발생: {e}")
+        logger.exception("예기치 않은 오류 발생: %s", e)
         return "예기치 않은 서버 오류가 발생했습니다.", 500
-    finally:
-        # --- 임시 파일 정리 ---
-        for temp_file_path in [temp_avatar_path, temp_audio_path, temp_video_path]:
-            if temp_file_path and os.path.exists(temp_file_path):
-                try:
-                    os.remove(temp_file_path)
-                    print(f"임시 파일 정리: {temp_file_path}")
-                except Exception as e:
-                    print(f"임시 파일 {temp_file_path} 정리 중 오류 발생: {e}")